@@ -1,26 +1,24 @@
 #! /somewhere/python3
+from collections import deque
 from contextlib import contextmanager, _GeneratorContextManager
 from queue import Queue, Empty
-from typing import Tuple, Any, Callable, Dict, Iterator, Optional, List, Iterable
+from typing import Tuple, Any, Callable, Deque, Dict, Iterator, Optional, List, Iterable
 from xml.sax.saxutils import XMLGenerator
 from colorama import Style
-import queue
-import io
 import _thread
 import argparse
 import atexit
-import base64
 import codecs
 import os
 import pathlib
 import ptpython.repl
 import pty
 import re
-import shlex
 import shutil
 import socket
 import subprocess
 import sys
+import threading
 import tempfile
 import time
 import traceback
@@ -89,6 +87,21 @@ CHAR_TO_KEY = {
     ")": "shift-0x0B",
 }
 
+# CHAR_TO_KEY as a table indexed by ord(char), all its keys are ASCII
+_KEY_TABLE: List[Optional[str]] = [CHAR_TO_KEY.get(chr(o)) for o in range(128)]
+
+# Complete encoded monitor command for typing each ASCII character
+_SENDKEY_LINES: List[bytes] = [
+    "sendkey {}\n".format(key or chr(o)).encode() for o, key in enumerate(_KEY_TABLE)
+]
+
+_LINE_PATTERN = re.compile(r"^([^=\n]+)=(.*)$", re.MULTILINE)
+_MACHINE_NAME_PATTERN = re.compile(r"run-(.+)-vm$")
+_WORD_PATTERN = re.compile(r"^\w+$")
+
+# Printed by the guest shell after each command, followed by its exit code
+_EOF_MARKER = "|!=EOF"
+
 # Forward references
 log: "Logger"
 machines: "List[Machine]"
@@ -98,7 +111,20 @@ def eprint(*args: object, **kwargs: Any) -> None:
     print(*args, file=sys.stderr, **kwargs)
 
 
+def _char_to_key(char: str) -> str:
+    """Translate a character into the name QEMU's sendkey expects,
+    passing through anything that is not in CHAR_TO_KEY.
+    """
+    if len(char) == 1:
+        o = ord(char)
+        if o < 128:
+            return _KEY_TABLE[o] or char
+    return char
+
+
 def make_command(args: list) -> str:
+    import shlex
+
     return " ".join(map(shlex.quote, (map(str, args))))
 
 
@@ -129,14 +155,20 @@ def create_vlan(vlan_nr: str) -> Tuple[str, str, "subprocess.Popen[bytes]", Any]
 
 
 def retry(fn: Callable, timeout: int = 900) -> None:
-    """Call the given function repeatedly, with 1 second intervals,
-    until it returns True or a timeout is reached.
+    """Call the given function repeatedly, with exponentially growing
+    intervals capped at 1 second, until it returns True or a timeout is reached.
     """
 
-    for _ in range(timeout):
+    deadline = time.monotonic() + timeout
+    delay = 0.05
+    while True:
         if fn(False):
             return
-        time.sleep(1)
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 1.5, 1.0)
 
     if not fn(True):
         raise Exception(f"action timed out after {timeout} seconds")
@@ -225,19 +257,36 @@ def _perform_ocr_on_screenshot(
         + "-contrast -normalize -despeckle -type grayscale "
         + "-sharpen 1 -posterize 3 -negate -gamma 100 "
         + "-blur 1x65535"
-    )
+    ).split()
 
-    tess_args = f"-c debug_file=/dev/null --psm 11"
+    tess_args = ["-c", "debug_file=/dev/null", "--psm", "11"]
 
-    cmd = f"convert {magick_args} {screenshot_path} tiff:{screenshot_path}.tiff"
-    ret = subprocess.run(cmd, shell=True, capture_output=True)
+    cmd = ["convert", *magick_args, screenshot_path, "tiff:-"]
+    ret = subprocess.run(cmd, capture_output=True)
     if ret.returncode != 0:
         raise Exception(f"TIFF conversion failed with exit code {ret.returncode}")
+    tiff = ret.stdout
+
+    def run_model(model_id: int) -> "subprocess.CompletedProcess[bytes]":
+        return subprocess.run(
+            ["tesseract", "stdin", "-", *tess_args, "--oem", str(model_id)],
+            input=tiff,
+            capture_output=True,
+            # Tesseract uses OpenMP, keep concurrent runs from oversubscribing
+            env={**os.environ, "OMP_THREAD_LIMIT": "1"},
+        )
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    # Run the models concurrently, each limited to a single thread.
+    # The engine mode is fixed per invocation and tesseract has no mode that
+    # keeps a process around for further images, so this is one run per model.
+    model_ids = list(model_ids)
+    with ThreadPoolExecutor(max_workers=len(model_ids)) as executor:
+        rets = list(executor.map(run_model, model_ids))
 
     model_results = []
-    for model_id in model_ids:
-        cmd = f"tesseract {screenshot_path}.tiff - {tess_args} --oem {model_id}"
-        ret = subprocess.run(cmd, shell=True, capture_output=True)
+    for ret in rets:
         if ret.returncode != 0:
             raise Exception(f"OCR failed with exit code {ret.returncode}")
         model_results.append(ret.stdout.decode("utf-8"))
@@ -253,7 +302,7 @@ class Machine:
             self.name = "machine"
             cmd = args.get("startCommand", None)
             if cmd:
-                match = re.search("run-(.+)-vm$", cmd)
+                match = _MACHINE_NAME_PATTERN.search(cmd)
                 if match:
                     self.name = match.group(1)
         self.logger = args["log"]
@@ -271,6 +320,7 @@ class Machine:
             self.cleanup_statedir()
         os.makedirs(self.state_dir, mode=0o700, exist_ok=True)
         self.shared_dir = create_dir("shared-xchg")
+        self.transfer_dir: Optional[pathlib.Path] = None
 
         self.booted = False
         self.connected = False
@@ -347,15 +397,15 @@ class Machine:
 
     def wait_for_monitor_prompt(self) -> str:
         assert self.monitor is not None
-        answer = ""
+        answer = bytearray()
         while True:
-            undecoded_answer = self.monitor.recv(1024)
-            if not undecoded_answer:
+            chunk = self.monitor.recv(4096)
+            if not chunk:
                 break
-            answer += undecoded_answer.decode()
-            if answer.endswith("(qemu) "):
+            answer += chunk
+            if answer.endswith(b"(qemu) "):
                 break
-        return answer
+        return answer.decode()
 
     def send_monitor_command(self, command: str) -> str:
         message = ("{}\n".format(command)).encode()
@@ -364,6 +414,25 @@ class Machine:
         self.monitor.send(message)
         return self.wait_for_monitor_prompt()
 
+    def _send_monitor_message(self, message: bytes, count: int) -> str:
+        """Send `count` newline-terminated commands to the QEMU monitor in a
+        single write and wait until a prompt has been received for each of them.
+        """
+        assert self.monitor is not None
+        self.monitor.sendall(message)
+
+        answer = bytearray()
+        prompts = 0
+        while prompts < count:
+            chunk = self.monitor.recv(4096)
+            if not chunk:
+                break
+            # Count only prompts that end in this chunk
+            start = max(0, len(answer) - len(b"(qemu) ") + 1)
+            answer += chunk
+            prompts += answer.count(b"(qemu) ", start)
+        return answer.decode()
+
     def wait_for_unit(self, unit: str, user: Optional[str] = None) -> None:
         """Wait for a systemd unit to get into "active" state.
         Throws exceptions on "failed" and "inactive" states as well as
@@ -400,18 +469,7 @@ class Machine:
                 )
             )
 
-        line_pattern = re.compile(r"^([^=]+)=(.*)$")
-
-        def tuple_from_line(line: str) -> Tuple[str, str]:
-            match = line_pattern.match(line)
-            assert match is not None
-            return match[1], match[2]
-
-        return dict(
-            tuple_from_line(line)
-            for line in lines.split("\n")
-            if line_pattern.match(line)
-        )
+        return dict(_LINE_PATTERN.findall(lines))
 
     def systemctl(self, q: str, user: Optional[str] = None) -> Tuple[int, str]:
         if user is not None:
@@ -440,27 +498,71 @@ class Machine:
     def execute(self, command: str) -> Tuple[int, str]:
         self.connect()
 
-        out_command = "( {} ); echo '|!=EOF' $?\n".format(command)
-        self.shell.send(out_command.encode())
+        # Commands get no stdin, the same as in _execute_batch where reading it
+        # would consume the commands queued behind them
+        out_command = "( {} ) < /dev/null; echo '{}' $?\n".format(command, _EOF_MARKER)
+        self.shell.sendall(out_command.encode())
+
+        return self._read_command_results(1)[0]
+
+    def _execute_batch(
+        self, commands: List[str], expect_success: bool
+    ) -> List[Tuple[int, str]]:
+        """Execute several commands with a single round trip to the guest shell.
+        Each command only runs while all previous ones succeeded (or failed, if
+        expect_success is False), skipped commands report the status of the
+        last one that ran.
+        """
+        if not commands:
+            return []
+        if len(commands) == 1:
+            return [self.execute(commands[0])]
+
+        self.connect()
+
+        check = "-eq" if expect_success else "-ne"
+        out_command = "_nixos_test_status={}\n".format(0 if expect_success else 1)
+        for command in commands:
+            out_command += (
+                "if [ $_nixos_test_status {} 0 ]; then ( {} ) < /dev/null; "
+                "_nixos_test_status=$?; fi; echo '{}' $_nixos_test_status\n"
+            ).format(check, command, _EOF_MARKER)
+        self.shell.sendall(out_command.encode())
+
+        return self._read_command_results(len(commands))
 
+    def _read_command_results(self, count: int) -> List[Tuple[int, str]]:
+        """Read the output and exit status of `count` commands from the shell."""
+        results: List[Tuple[int, str]] = []
         output = ""
-        status_code_pattern = re.compile(r"(.*)\|\!=EOF\s+(\d+)")
+        # Only look at data that has not been searched for the marker yet
+        scanned = 0
 
-        while True:
-            chunk = self.shell.recv(4096).decode(errors="ignore")
-            match = status_code_pattern.match(chunk)
-            if match:
-                output += match[1]
-                status_code = int(match[2])
-                return (status_code, output)
-            output += chunk
+        while len(results) < count:
+            marker = output.find(_EOF_MARKER, scanned)
+            if marker < 0:
+                scanned = max(0, len(output) - len(_EOF_MARKER) + 1)
+            else:
+                scanned = marker
+                end = output.find("\n", marker)
+                if end >= 0:
+                    status_code = int(output[marker + len(_EOF_MARKER) : end])
+                    results.append((status_code, output[:marker]))
+                    output = output[end + 1 :]
+                    scanned = 0
+                    continue
+            output += self.shell.recv(4096).decode(errors="ignore")
+
+        return results
 
     def succeed(self, *commands: str) -> str:
         """Execute each command and check that it succeeds."""
         output = ""
-        for command in commands:
-            with self.nested("must succeed: {}".format(command)):
-                (status, out) = self.execute(command)
+        if not commands:
+            return output
+        with self.nested("must succeed: {}".format("; ".join(commands))):
+            results = self._execute_batch(list(commands), expect_success=True)
+            for command, (status, out) in zip(commands, results):
                 if status != 0:
                     self.log("output: {}".format(out))
                     raise Exception(
@@ -472,9 +574,11 @@ class Machine:
     def fail(self, *commands: str) -> str:
         """Execute each command and check that it fails."""
         output = ""
-        for command in commands:
-            with self.nested("must fail: {}".format(command)):
-                (status, out) = self.execute(command)
+        if not commands:
+            return output
+        with self.nested("must fail: {}".format("; ".join(commands))):
+            results = self._execute_batch(list(commands), expect_success=False)
+            for command, (status, out) in zip(commands, results):
                 if status == 0:
                     raise Exception(
                         "command `{}` unexpectedly succeeded".format(command)
@@ -551,8 +655,14 @@ class Machine:
 
     def send_chars(self, chars: List[str]) -> None:
         with self.nested("sending keys ‘{}‘".format(chars)):
-            for char in chars:
-                self.send_key(char)
+            try:
+                message = b"".join([_SENDKEY_LINES[ord(char)] for char in chars])
+            except (IndexError, TypeError):
+                # Not just ASCII characters, translate them one by one
+                message = "".join(
+                    "sendkey {}\n".format(_char_to_key(char)) for char in chars
+                ).encode()
+            self._send_monitor_message(message, len(chars))
 
     def wait_for_file(self, filename: str) -> None:
         """Waits until the file exists in machine's file system."""
@@ -565,6 +675,10 @@ class Machine:
             retry(check_file)
 
     def wait_for_open_port(self, port: int) -> None:
+        # Probing through a forward_port() mapping from the host is not
+        # equivalent: QEMU's user networking accepts the host side of a
+        # hostfwd even if nothing listens in the guest, and it reaches the
+        # guest's external address rather than localhost.
         def port_is_open(_: Any) -> bool:
             status, _ = self.execute("nc -z localhost {}".format(port))
             return status == 0
@@ -606,8 +720,7 @@ class Machine:
 
     def screenshot(self, filename: str) -> None:
         out_dir = os.environ.get("out", os.getcwd())
-        word_pattern = re.compile(r"^\w+$")
-        if word_pattern.match(filename):
+        if _WORD_PATTERN.match(filename):
             filename = os.path.join(out_dir, "{}.png".format(filename))
         tmp = "{}.ppm".format(filename)
 
@@ -616,7 +729,8 @@ class Machine:
             {"image": os.path.basename(filename)},
         ):
             self.send_monitor_command("screendump {}".format(tmp))
-            ret = subprocess.run("pnmtopng {} > {}".format(tmp, filename), shell=True)
+            with open(filename, "wb") as fh:
+                ret = subprocess.run(["pnmtopng", tmp], stdout=fh)
             os.unlink(tmp)
             if ret.returncode != 0:
                 raise Exception("Cannot convert screenshot")
@@ -626,12 +740,39 @@ class Machine:
         shell into the destination file. Works without host-guest shared folder.
         Prefer copy_from_host for whenever possible.
         """
+        import base64
+
+        self.succeed(f"mkdir -p $(dirname {target})", f": > {target}")
         with open(source, "rb") as fh:
-            content_b64 = base64.b64encode(fh.read()).decode()
-            self.succeed(
-                f"mkdir -p $(dirname {target})",
-                f"echo -n {content_b64} | base64 -d > {target}",
-            )
+            # Send the file in chunks to keep the command lines short
+            while True:
+                chunk = fh.read(48 * 1024)
+                if not chunk:
+                    break
+                content_b64 = base64.b64encode(chunk).decode()
+                self.succeed(f"echo -n {content_b64} | base64 -d >> {target}")
+
+    @contextmanager
+    def _shared_temp_dir(self) -> Iterator[Tuple[pathlib.Path, pathlib.Path]]:
+        """Create a temporary directory in `shared_dir` and yield its path on
+        the host and in the VM. The parent directory is created once per
+        machine and removed when the driver exits.
+        """
+        if self.transfer_dir is None:
+            transfer_dir = pathlib.Path(tempfile.mkdtemp(dir=self.shared_dir))
+            atexit.register(shutil.rmtree, transfer_dir, ignore_errors=True)
+            vm_transfer_dir = pathlib.Path("/tmp/shared") / transfer_dir.name
+            self.succeed(make_command(["mkdir", "-p", vm_transfer_dir]))
+            self.transfer_dir = transfer_dir
+
+        shared_temp = pathlib.Path(tempfile.mkdtemp(dir=self.transfer_dir))
+        vm_shared_temp = (
+            pathlib.Path("/tmp/shared") / self.transfer_dir.name / shared_temp.name
+        )
+        try:
+            yield shared_temp, vm_shared_temp
+        finally:
+            shutil.rmtree(shared_temp, ignore_errors=True)
 
     def copy_from_host(self, source: str, target: str) -> None:
         """Copy a file from the host into the guest via the `shared_dir` shared
@@ -639,13 +780,10 @@ class Machine:
         """
         host_src = pathlib.Path(source)
         vm_target = pathlib.Path(target)
-        with tempfile.TemporaryDirectory(dir=self.shared_dir) as shared_td:
-            shared_temp = pathlib.Path(shared_td)
+        with self._shared_temp_dir() as (shared_temp, vm_shared_temp):
             host_intermediate = shared_temp / host_src.name
-            vm_shared_temp = pathlib.Path("/tmp/shared") / shared_temp.name
             vm_intermediate = vm_shared_temp / host_src.name
 
-            self.succeed(make_command(["mkdir", "-p", vm_shared_temp]))
             if host_src.is_dir():
                 shutil.copytree(host_src, host_intermediate)
             else:
@@ -661,13 +799,10 @@ class Machine:
         # Compute the source, target, and intermediate shared file names
         out_dir = pathlib.Path(os.environ.get("out", os.getcwd()))
         vm_src = pathlib.Path(source)
-        with tempfile.TemporaryDirectory(dir=self.shared_dir) as shared_td:
-            shared_temp = pathlib.Path(shared_td)
-            vm_shared_temp = pathlib.Path("/tmp/shared") / shared_temp.name
+        with self._shared_temp_dir() as (shared_temp, vm_shared_temp):
             vm_intermediate = vm_shared_temp / vm_src.name
             intermediate = shared_temp / vm_src.name
             # Copy the file to the shared directory inside VM
-            self.succeed(make_command(["mkdir", "-p", vm_shared_temp]))
             self.succeed(make_command(["cp", "-r", vm_src, vm_intermediate]))
             abs_target = out_dir / target_dir / vm_src.name
             abs_target.parent.mkdir(exist_ok=True, parents=True)
@@ -694,11 +829,12 @@ class Machine:
         return self._get_screen_text_variants([2])[0]
 
     def wait_for_text(self, regex: str) -> None:
+        pattern = re.compile(regex)
+
         def screen_matches(last: bool) -> bool:
             variants = self.get_screen_text_variants()
-            for text in variants:
-                if re.search(regex, text) is not None:
-                    return True
+            if any(pattern.search(text) for text in variants):
+                return True
 
             if last:
                 self.log("Last OCR attempt failed. Text was: {}".format(variants))
@@ -708,25 +844,31 @@ class Machine:
         with self.nested("waiting for {} to appear on screen".format(regex)):
             retry(screen_matches)
 
-    def wait_for_console_text(self, regex: str) -> None:
+    def wait_for_console_text(self, regex: str, timeout: int = 900) -> None:
         self.log("waiting for {} to appear on console".format(regex))
+        pattern = re.compile(regex)
+        deadline = time.monotonic() + timeout
         # Buffer the console output, this is needed
         # to match multiline regexes.
-        console = io.StringIO()
-        while True:
-            try:
-                console.write(self.last_lines.get())
-            except queue.Empty:
-                self.sleep(1)
-                continue
-            console.seek(0)
-            matches = re.search(regex, console.read())
-            if matches is not None:
-                return
+        console = ""
+        with self.last_lines_cond:
+            while True:
+                while not self.last_lines:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise Exception(
+                            f"timed out after {timeout} seconds waiting for "
+                            f"{regex} to appear on console"
+                        )
+                    self.last_lines_cond.wait(remaining)
+                # Consume one line at a time, so that lines after the match
+                # are left for the next call
+                console += self.last_lines.popleft() + "\n"
+                if pattern.search(console) is not None:
+                    return
 
     def send_key(self, key: str) -> None:
-        key = CHAR_TO_KEY.get(key, key)
-        self.send_monitor_command("sendkey {}".format(key))
+        self.send_monitor_command("sendkey {}".format(_char_to_key(key)))
 
     def start(self) -> None:
         if self.booted:
@@ -780,6 +922,7 @@ class Machine:
             stdin=subprocess.DEVNULL,
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT,
+            bufsize=65536,
             shell=True,
             cwd=self.state_dir,
             env=environment,
@@ -789,15 +932,32 @@ class Machine:
 
         # Store last serial console lines for use
         # of wait_for_console_text
-        self.last_lines: Queue = Queue()
+        self.last_lines: Deque[str] = deque(maxlen=4096)
+        self.last_lines_cond = threading.Condition()
+
+        def publish_lines(data: bytes) -> None:
+            # Ignore undecodable bytes that may occur in boot menus
+            text = data.decode(errors="ignore").replace("\r", "")
+            lines = [line.rstrip() for line in text.split("\n")]
+            with self.last_lines_cond:
+                self.last_lines.extend(lines)
+                self.last_lines_cond.notify_all()
+            for line in lines:
+                self.log_serial(line)
 
         def process_serial_output() -> None:
             assert self.process.stdout is not None
-            for _line in self.process.stdout:
-                # Ignore undecodable bytes that may occur in boot menus
-                line = _line.decode(errors="ignore").replace("\r", "").rstrip()
-                self.last_lines.put(line)
-                self.log_serial(line)
+            # Decode whatever has arrived at once, keeping back a partial line
+            pending = b""
+            while True:
+                chunk = self.process.stdout.read1(65536)  # type: ignore
+                if not chunk:
+                    break
+                complete, _, pending = (pending + chunk).rpartition(b"\n")
+                if complete:
+                    publish_lines(complete)
+            if pending:
+                publish_lines(pending)
 
         _thread.start_new_thread(process_serial_output, ())
 